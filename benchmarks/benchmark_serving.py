@@ -31,7 +31,7 @@ On the client side, run:
       dataset flags to the command below, and make some changes to the tokenizer logic in the 
       benchmark script (get_tokenizer and sample_requests func) to use your tokenizer correctly.
     * Add `--save-result` flag to save the benchmark result to a json file in current folder.
-    * Add `--threads` flag to set the maximum number of threads used for request dispatching.
+    * Add `--max-concurrency` flag to limit the number of requests in flight (unlimited by default).
 
     (run with real model and engines)
     python -m benchmarks.benchmark_serving \
@@ -50,22 +50,41 @@ import tensorflow as tf
 import tensorflow_text as tftxt
 
 import argparse
+import array
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
-from dataclasses import dataclass
+import contextlib
+from dataclasses import dataclass, field
 from datetime import datetime
+import hashlib
+import itertools
 import json
+import os
 import random
 import time
-from typing import Any, AsyncGenerator, List, Tuple
+from typing import Any, AsyncGenerator, List, Tuple, TypeVar
 import grpc
 from jetstream.core.proto import jetstream_pb2
 from jetstream.core.proto import jetstream_pb2_grpc
 import numpy as np
+import orjson
 from tqdm.asyncio import tqdm
 
 
-@dataclass
+_T = TypeVar("_T")
+
+
+# Channel options for a client that keeps many streaming RPCs in flight.
+# Keepalive pings are left disabled: the JetStream server uses gRPC's default
+# policy, which sends GOAWAY to clients pinging more than every 5 minutes.
+_GRPC_CHANNEL_OPTIONS = [
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+    ("grpc.use_local_subchannel_pool", 1),
+    ("grpc.optimization_target", "throughput"),
+]
+
+
+@dataclass(slots=True)
 class BenchmarkMetrics:
   completed: int
   total_input: int
@@ -75,33 +94,62 @@ class BenchmarkMetrics:
   output_throughput: float
   mean_ttft_ms: float
   median_ttft_ms: float
-  p99_ttft_ms: float
+  percentiles_ttft_ms: List[Tuple[float, float]]
   mean_tpot_ms: float
   median_tpot_ms: float
-  p99_tpot_ms: float
-
-
-@dataclass
+  percentiles_tpot_ms: List[Tuple[float, float]]
+  mean_itl_ms: float
+  median_itl_ms: float
+  percentiles_itl_ms: List[Tuple[float, float]]
+  mean_e2el_ms: float
+  median_e2el_ms: float
+  percentiles_e2el_ms: List[Tuple[float, float]]
+  mean_queue_delay_ms: float
+  median_queue_delay_ms: float
+  percentiles_queue_delay_ms: List[Tuple[float, float]]
+
+
+@dataclass(slots=True)
 class InputRequest:
   prompt: str = ""
   prompt_len: int = 0
   output: str = ""
   output_len: int = 0
 
-@dataclass
+@dataclass(slots=True)
 class RequestFuncOutput:
   input_request: InputRequest = None
-  generated_token_list: list[str] = None
+  # All generated tokens concatenated, plus the end offset of each token in
+  # that string, instead of one str object per token.
+  generated_text: str = ""
+  token_end_offsets: array.array = field(
+      default_factory=lambda: array.array("I")
+  )
   success: bool = False
   latency: float = 0
   ttft: float = 0
+  # Time from the scheduled arrival until the request was sent.
+  queue_delay: float = 0
+  # Arrival time of each generated token, in ns since the request was sent.
+  token_times_ns: array.array = field(
+      default_factory=lambda: array.array("q")
+  )
   prompt_len: int = 0
 
+  @property
+  def generated_token_list(self) -> list[str]:
+    starts = itertools.chain((0,), self.token_end_offsets)
+    return [
+        self.generated_text[start:end]
+        for start, end in zip(starts, self.token_end_offsets)
+    ]
+
   # Flatten the structure and return only the necessary results
   def to_dict(self): 
     return {
       "prompt": self.input_request.prompt,
       "original_output": self.input_request.output,
+      "generated_text": self.generated_text,
       "generated_token_list": self.generated_token_list,
       "success": self.success,
       "latency": self.latency,
@@ -120,12 +168,46 @@ def get_tokenizer(tokenizer_name: str) -> Any:
         model=sp_model, add_bos=True, add_eos=False, reverse=False)
     return sp_tokenizer
 
-def sample_requests(
+def get_token_lengths(tokenizer: Any, texts: List[str]) -> np.ndarray:
+  """Return the number of tokens in each text without materializing token ids.
+
+  Replace this with a faster length-only tokenizer if one is available.
+  """
+  # adjust this code based on tokenizer method
+  return tokenizer.tokenize(texts).row_lengths().numpy()
+
+
+def load_tokenized_dataset(
     dataset_path: str,
-    num_requests: int,
     tokenizer: Any,
-    max_output_length: int,
-) -> List[InputRequest]:
+    tokenizer_name: str,
+    cache_dir: str,
+) -> Tuple[List[Tuple[str, str]], np.ndarray, np.ndarray]:
+  """Load (prompt, completion) pairs with their token lengths.
+
+  The result is cached in cache_dir, keyed on the dataset and tokenizer model
+  contents, so repeated runs skip parsing and tokenization. An empty
+  cache_dir disables the cache.
+  """
+  pairs_path = lens_path = None
+  if cache_dir:
+    key = hashlib.sha1()
+    with open(dataset_path, "rb") as f:
+      for chunk in iter(lambda: f.read(1 << 20), b""):
+        key.update(chunk)
+    with tf.io.gfile.GFile(tokenizer_name, "rb") as f:
+      key.update(f.read())
+    cache_prefix = os.path.join(cache_dir, f"tokenized_{key.hexdigest()}")
+    pairs_path = f"{cache_prefix}.json"
+    lens_path = f"{cache_prefix}.npz"
+    # The lengths are written last, so their presence means both files are
+    # complete.
+    if os.path.exists(lens_path) and os.path.exists(pairs_path):
+      with open(pairs_path, "rb") as f:
+        dataset = [tuple(pair) for pair in orjson.loads(f.read())]
+      with np.load(lens_path, allow_pickle=False) as lens:
+        return dataset, lens["prompt_lens"], lens["output_lens"]
+
   # Load the dataset.
   with open(dataset_path) as f:
     dataset = json.load(f)
@@ -137,85 +219,190 @@ def sample_requests(
       for data in dataset
   ]
 
-  # some of these will be filtered out, so sample more than we need
-  sampled_indices = random.sample(range(len(dataset)), int(num_requests * 1.2))
-  dataset = [dataset[i] for i in sampled_indices]
-
-  # Tokenize the prompts and completions.
+  # Tokenize the prompts and completions in a single batched call.
   prompts = [prompt for prompt, _ in dataset]
-  prompt_token_ids = tokenizer.tokenize(
-      prompts
-  )  # adjust this code based on tokenizer method
   completions = [completion for _, completion in dataset]
-  completion_token_ids = tokenizer.tokenize(
-      completions
-  )  # adjust this code based on tokenizer method
-  tokenized_dataset = []
-  for i in range(len(dataset)):
-    output_len = len(completion_token_ids[i])
-    tokenized_dataset.append((prompts[i], prompt_token_ids[i], completions[i], output_len))
-
-  # Filter out too long sequences.
-  filtered_dataset: List[InputRequest] = []
-
-  for prompt, prompt_token_ids, output, output_len in tokenized_dataset:
-    prompt_len = len(prompt_token_ids)
-    if prompt_len < 4 or output_len < 4:
-      # Prune too short sequences.
-      # This is because TGI causes errors when the input or output length
-      # is too short.
-      continue
-    if prompt_len > 1024 or prompt_len + output_len > 2048:
-      # Prune too long sequences.
-      continue
-    reqeust = InputRequest(prompt, prompt_len, output, max_output_length)
-    filtered_dataset.append(reqeust)
-
-  # Sample the requests.
-  sampled_requests = random.sample(filtered_dataset, num_requests)
+  token_lens = get_token_lengths(tokenizer, prompts + completions)
+  tokenized_dataset = (
+      dataset,
+      token_lens[:len(prompts)],
+      token_lens[len(prompts):],
+  )
+
+  if cache_dir:
+    # Write to temporary files first so an interrupted run never leaves a
+    # truncated cache behind.
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    with open(f"{pairs_path}.tmp", "wb") as f:
+      f.write(orjson.dumps(dataset))
+    os.replace(f"{pairs_path}.tmp", pairs_path)
+    with open(f"{lens_path}.tmp", "wb") as f:
+      np.savez(
+          f,
+          prompt_lens=tokenized_dataset[1],
+          output_lens=tokenized_dataset[2],
+      )
+    os.replace(f"{lens_path}.tmp", lens_path)
+  return tokenized_dataset
+
+
+def sample_requests(
+    dataset_path: str,
+    num_requests: int,
+    tokenizer: Any,
+    tokenizer_name: str,
+    max_output_length: int,
+    cache_dir: str,
+    seed: int,
+) -> List[InputRequest]:
+  dataset, prompt_lens, output_lens = load_tokenized_dataset(
+      dataset_path, tokenizer, tokenizer_name, cache_dir
+  )
+
+  # Filter out too short and too long sequences. Too short sequences are
+  # pruned because TGI causes errors when the input or output length is too
+  # short.
+  valid_indices = np.flatnonzero(
+      (prompt_lens >= 4)
+      & (output_lens >= 4)
+      & (prompt_lens <= 1024)
+      & (prompt_lens + output_lens <= 2048)
+  )
+
+  # Sample the requests, only building InputRequests for the sampled rows.
+  rng = np.random.default_rng(seed)
+  sampled_indices = rng.choice(valid_indices, num_requests, replace=False)
+  sampled_requests = [
+      InputRequest(
+          dataset[i][0], int(prompt_lens[i]), dataset[i][1], max_output_length
+      )
+      for i in sampled_indices
+  ]
   return sampled_requests
 
 
 async def get_request(
-    input_requests: List[InputRequest],
+    requests: List[_T],
     request_rate: float,
-) -> AsyncGenerator[InputRequest, None]:
-  input_requests = iter(input_requests)
-  for request in input_requests:
-    yield request
-
-    if request_rate == float("inf"):
-      # If the request rate is infinity, then we don't need to wait.
-      continue
-    # Sample the request interval from the exponential distribution.
-    interval = np.random.exponential(1.0 / request_rate)
-    # The next request will be sent after the interval.
-    await asyncio.sleep(interval)
+) -> AsyncGenerator[Tuple[_T, int], None]:
+  """Yields each request with its scheduled send time in monotonic ns."""
+  start_time_ns = time.monotonic_ns()
+  if request_rate == float("inf"):
+    # If the request rate is infinity, then we don't need to wait.
+    for request in requests:
+      yield request, start_time_ns
+    return
+
+  # Sample all the request intervals from the exponential distribution at once.
+  intervals = np.random.exponential(
+      1.0 / request_rate, size=len(requests)
+  )
+  # Each request is sent after the sum of the intervals before it. Sleeping
+  # until that absolute time, rather than for each interval, keeps the time
+  # spent dispatching earlier requests from slowing down the arrival rate.
+  send_times_ns = start_time_ns + (
+      (np.cumsum(intervals) - intervals) * 1e9
+  ).astype(np.int64)
+  for request, send_time_ns in zip(requests, send_times_ns.tolist()):
+    delay_ns = send_time_ns - time.monotonic_ns()
+    if delay_ns > 0:
+      await asyncio.sleep(delay_ns / 1e9)
+    yield request, send_time_ns
+
+
+def summarize_ms(
+    values: np.ndarray,
+    selected_percentiles: List[float],
+) -> Tuple[float, float, List[Tuple[float, float]]]:
+  """Return the mean, median and selected percentiles of values in ms."""
+  if not values.size:
+    return 0.0, 0.0, [(p, 0.0) for p in selected_percentiles]
+  # A single np.percentile call selects the median and every requested
+  # percentile in one partitioning pass over the data.
+  quantiles = np.percentile(values, [50, *selected_percentiles]) * 1000
+  return (
+      np.mean(values) * 1000,
+      quantiles[0],
+      list(zip(selected_percentiles, quantiles[1:])),
+  )
 
 
 def calculate_metrics(
-    input_requests: List[InputRequest],
     outputs: List[RequestFuncOutput],
     dur_s: float,
     tokenizer: Any,
+    selected_percentiles: List[float],
 ) -> BenchmarkMetrics:
-  total_output = 0
-  total_input = 0
-  completed = 0
-  per_token_latencies = []
-  ttfts = []
-  for i in range(len(outputs)):
-    if outputs[i].success:
-      output_len = len(
-          outputs[i].generated_token_list
-          if tokenizer != "test"
-          else ["Ċ", "Ō", "Ɵ"]
-      )
-      total_output += output_len
-      total_input += input_requests[i].prompt_len
-      per_token_latencies.append(outputs[i].latency / output_len)
-      ttfts.append(outputs[i].ttft)
-      completed += 1
+  completed_outputs = [output for output in outputs if output.success]
+  completed = len(completed_outputs)
+  input_lens = np.fromiter(
+      (output.prompt_len for output in completed_outputs),
+      dtype=np.int64,
+      count=completed,
+  )
+  if tokenizer == "test":
+    # Mock outputs are counted as three tokens, e.g. ["Ċ", "Ō", "Ɵ"].
+    output_lens = np.full(completed, 3, dtype=np.int64)
+  else:
+    output_lens = np.fromiter(
+        (len(output.token_end_offsets) for output in completed_outputs),
+        dtype=np.int64,
+        count=completed,
+    )
+  latencies = np.fromiter(
+      (output.latency for output in completed_outputs),
+      dtype=np.float64,
+      count=completed,
+  )
+  ttfts = np.fromiter(
+      (output.ttft for output in completed_outputs),
+      dtype=np.float64,
+      count=completed,
+  )
+  queue_delays = np.fromiter(
+      (output.queue_delay for output in completed_outputs),
+      dtype=np.float64,
+      count=completed,
+  )
+  # Outputs without tokens have no time per output token.
+  has_tokens = output_lens > 0
+  per_token_latencies = latencies[has_tokens] / output_lens[has_tokens]
+  token_counts = np.fromiter(
+      (len(output.token_times_ns) for output in completed_outputs),
+      dtype=np.int64,
+      count=completed,
+  )
+  token_times_ns = np.fromiter(
+      itertools.chain.from_iterable(
+          output.token_times_ns for output in completed_outputs
+      ),
+      dtype=np.int64,
+      count=int(token_counts.sum()),
+  )
+  # Diff all token times at once, then drop the differences that end on a
+  # request's first token, since those span two requests.
+  is_first_token = np.zeros(len(token_times_ns), dtype=bool)
+  first_token_indices = np.cumsum(token_counts) - token_counts
+  is_first_token[first_token_indices[token_counts > 0]] = True
+  itls = np.diff(token_times_ns)[~is_first_token[1:]] / 1e9
+  total_input = int(input_lens.sum())
+  total_output = int(output_lens.sum())
+
+  mean_ttft_ms, median_ttft_ms, percentiles_ttft_ms = summarize_ms(
+      ttfts, selected_percentiles
+  )
+  mean_tpot_ms, median_tpot_ms, percentiles_tpot_ms = summarize_ms(
+      per_token_latencies, selected_percentiles
+  )
+  mean_itl_ms, median_itl_ms, percentiles_itl_ms = summarize_ms(
+      itls, selected_percentiles
+  )
+  mean_e2el_ms, median_e2el_ms, percentiles_e2el_ms = summarize_ms(
+      latencies, selected_percentiles
+  )
+  mean_queue_delay_ms, median_queue_delay_ms, percentiles_queue_delay_ms = (
+      summarize_ms(queue_delays, selected_percentiles)
+  )
 
   metrics = BenchmarkMetrics(
       completed=completed,
@@ -224,61 +411,65 @@ def calculate_metrics(
       request_throughput=completed / dur_s,
       input_throughput=total_input / dur_s,
       output_throughput=total_output / dur_s,
-      mean_ttft_ms=np.mean(ttfts) * 1000,
-      median_ttft_ms=np.median(ttfts) * 1000,
-      p99_ttft_ms=np.percentile(ttfts, 99) * 1000,
-      mean_tpot_ms=np.mean(per_token_latencies) * 1000,
-      median_tpot_ms=np.median(per_token_latencies) * 1000,
-      p99_tpot_ms=np.percentile(per_token_latencies, 99) * 1000,
+      mean_ttft_ms=mean_ttft_ms,
+      median_ttft_ms=median_ttft_ms,
+      percentiles_ttft_ms=percentiles_ttft_ms,
+      mean_tpot_ms=mean_tpot_ms,
+      median_tpot_ms=median_tpot_ms,
+      percentiles_tpot_ms=percentiles_tpot_ms,
+      mean_itl_ms=mean_itl_ms,
+      median_itl_ms=median_itl_ms,
+      percentiles_itl_ms=percentiles_itl_ms,
+      mean_e2el_ms=mean_e2el_ms,
+      median_e2el_ms=median_e2el_ms,
+      percentiles_e2el_ms=percentiles_e2el_ms,
+      mean_queue_delay_ms=mean_queue_delay_ms,
+      median_queue_delay_ms=median_queue_delay_ms,
+      percentiles_queue_delay_ms=percentiles_queue_delay_ms,
   )
 
   return metrics
 
 
-def grpc_sync_request(api_url: str, request: Any) -> tuple[list[str], float, float]:
-  """Send grpc synchronous request since the current grpc server is sync."""
-  with grpc.insecure_channel(api_url) as channel:
-    grpc.channel_ready_future(channel).result()
-    stub = jetstream_pb2_grpc.OrchestratorStub(channel)
-    print("Making request")
-    ttft = 0
-    token_list = []
-    request_start_time = time.perf_counter()
-    response = stub.Decode(request)
-    for token in response:
-      if ttft == 0:
-        ttft = time.perf_counter() - request_start_time
-      token_list.append(token.response[0])
-    latency = time.perf_counter() - request_start_time
-    return token_list, ttft, latency
-
-
 async def send_request(
-    api_url: str,
+    stub: jetstream_pb2_grpc.OrchestratorStub,
     input_request: InputRequest,
+    request: jetstream_pb2.DecodeRequest,
     pbar: tqdm,
-    session_cache: str,
-    priority: int,
-    threads: int,
+    arrival_time_ns: int,
 ) -> RequestFuncOutput:
-  """Send the request to JetStream server."""
-  loop = asyncio.get_running_loop()
-  loop.set_default_executor(ThreadPoolExecutor(max_workers=threads))
-  request = jetstream_pb2.DecodeRequest(
-      session_cache=session_cache,
-      additional_text=input_request.prompt,
-      priority=priority,
-      max_tokens=input_request.output_len,
-  )
+  """Send the request to JetStream server.
+
+  TTFT and latency are measured from when the RPC is sent. The time between
+  arrival_time_ns, the scheduled monotonic_ns arrival time of the request,
+  and the RPC being sent is recorded separately as the queue delay.
+  """
   output = RequestFuncOutput()
   output.input_request = input_request
   output.prompt_len = input_request.prompt_len
-  generated_token_list, ttft, latency = await loop.run_in_executor(
-      None, grpc_sync_request, api_url, request
+  ttft_ns = 0
+  token_list = []
+  token_times_ns = array.array("q")
+  request_start_time_ns = time.monotonic_ns()
+  output.queue_delay = (request_start_time_ns - arrival_time_ns) / 1e9
+  responses = aiter(stub.Decode(request))
+  # Take the first token separately so the TTFT check stays out of the loop.
+  first_token = await anext(responses, None)
+  if first_token is not None:
+    ttft_ns = time.monotonic_ns() - request_start_time_ns
+    token_list.append(first_token.response[0])
+    token_times_ns.append(ttft_ns)
+    async for token in responses:
+      token_times_ns.append(time.monotonic_ns() - request_start_time_ns)
+      token_list.append(token.response[0])
+  latency_ns = time.monotonic_ns() - request_start_time_ns
+  output.ttft = ttft_ns / 1e9
+  output.latency = latency_ns / 1e9
+  output.token_times_ns = token_times_ns
+  output.generated_text = "".join(token_list)
+  output.token_end_offsets = array.array(
+      "I", itertools.accumulate(map(len, token_list))
   )
-  output.ttft = ttft
-  output.latency = latency
-  output.generated_token_list = generated_token_list
   output.success = True
   if pbar:
     pbar.update(1)
@@ -293,29 +484,76 @@ async def benchmark(
     disable_tqdm: bool,
     session_cache: str,
     priority: int,
-    threads: int,
+    max_concurrency: int | None,
+    num_channels: int,
+    selected_percentiles: List[float],
 ):
   """Benchmark the online serving performance."""
   pbar = None if disable_tqdm else tqdm(total=len(input_requests))
 
   print(f"Traffic request rate: {request_rate}")
 
-  benchmark_start_time = time.perf_counter()
-  tasks = []
-  async for request in get_request(input_requests, request_rate):
-    tasks.append(
-        asyncio.create_task(
-            send_request(
-                api_url=api_url,
-                input_request=request,
-                pbar=pbar,
-                session_cache=session_cache,
-                priority=priority,
-                threads=threads,
+  # Build the protos up front so that dispatch only has to send them.
+  requests = [
+      (
+          input_request,
+          jetstream_pb2.DecodeRequest(
+              session_cache=session_cache,
+              additional_text=input_request.prompt,
+              priority=priority,
+              max_tokens=input_request.output_len,
+          ),
+      )
+      for input_request in input_requests
+  ]
+
+  # Spread the requests round-robin over num_channels shared channels, and
+  # only wait for them to be ready once. With a local subchannel pool each
+  # channel has its own connection to the server.
+  async with contextlib.AsyncExitStack() as stack:
+    channels = [
+        await stack.enter_async_context(
+            grpc.aio.insecure_channel(
+                api_url,
+                options=_GRPC_CHANNEL_OPTIONS,
+                compression=grpc.Compression.NoCompression,
             )
         )
+        for _ in range(num_channels)
+    ]
+    await asyncio.gather(*(channel.channel_ready() for channel in channels))
+    stubs = itertools.cycle(
+        [jetstream_pb2_grpc.OrchestratorStub(channel) for channel in channels]
+    )
+
+    # With a cap, tasks are only created once a slot is free, so at most
+    # max_concurrency requests (and their coroutines) are alive at any time.
+    semaphore = (
+        asyncio.Semaphore(max_concurrency)
+        if max_concurrency is not None
+        else None
     )
-  outputs = await asyncio.gather(*tasks)
+    benchmark_start_time = time.perf_counter()
+    tasks = []
+    async for (input_request, request), arrival_time_ns in get_request(
+        requests, request_rate
+    ):
+      # Any wait for a free slot is reported as the request's queue delay.
+      if semaphore is not None:
+        await semaphore.acquire()
+      task = asyncio.create_task(
+          send_request(
+              stub=next(stubs),
+              input_request=input_request,
+              request=request,
+              pbar=pbar,
+              arrival_time_ns=arrival_time_ns,
+          )
+      )
+      if semaphore is not None:
+        task.add_done_callback(lambda _: semaphore.release())
+      tasks.append(task)
+    outputs = await asyncio.gather(*tasks)
 
   if not disable_tqdm:
     pbar.close()
@@ -323,10 +561,10 @@ async def benchmark(
   benchmark_duration = time.perf_counter() - benchmark_start_time
 
   metrics = calculate_metrics(
-      input_requests=input_requests,
       outputs=outputs,
       dur_s=benchmark_duration,
       tokenizer=tokenizer,
+      selected_percentiles=selected_percentiles,
   )
 
   print(f"Successful requests: {metrics.completed}")
@@ -338,10 +576,24 @@ async def benchmark(
   print(f"Output token throughput: {metrics.output_throughput:.2f} tokens/s")
   print(f"Mean TTFT: {metrics.mean_ttft_ms:.2f} ms")
   print(f"Median TTFT: {metrics.median_ttft_ms:.2f} ms")
-  print(f"P99 TTFT: {metrics.p99_ttft_ms:.2f} ms")
+  for p, value in metrics.percentiles_ttft_ms:
+    print(f"P{p:g} TTFT: {value:.2f} ms")
   print(f"Mean TPOT: {metrics.mean_tpot_ms:.2f} ms")
   print(f"Median TPOT: {metrics.median_tpot_ms:.2f} ms")
-  print(f"P99 TPOT: {metrics.p99_tpot_ms:.2f} ms")
+  for p, value in metrics.percentiles_tpot_ms:
+    print(f"P{p:g} TPOT: {value:.2f} ms")
+  print(f"Mean ITL: {metrics.mean_itl_ms:.2f} ms")
+  print(f"Median ITL: {metrics.median_itl_ms:.2f} ms")
+  for p, value in metrics.percentiles_itl_ms:
+    print(f"P{p:g} ITL: {value:.2f} ms")
+  print(f"Mean E2EL: {metrics.mean_e2el_ms:.2f} ms")
+  print(f"Median E2EL: {metrics.median_e2el_ms:.2f} ms")
+  for p, value in metrics.percentiles_e2el_ms:
+    print(f"P{p:g} E2EL: {value:.2f} ms")
+  print(f"Mean queue delay: {metrics.mean_queue_delay_ms:.2f} ms")
+  print(f"Median queue delay: {metrics.median_queue_delay_ms:.2f} ms")
+  for p, value in metrics.percentiles_queue_delay_ms:
+    print(f"P{p:g} queue delay: {value:.2f} ms")
 
   result = {
       "duration": benchmark_duration,
@@ -353,29 +605,74 @@ async def benchmark(
       "output_throughput": metrics.output_throughput,
       "mean_ttft_ms": metrics.mean_ttft_ms,
       "median_ttft_ms": metrics.median_ttft_ms,
-      "p99_ttft_ms": metrics.p99_ttft_ms,
       "mean_tpot_ms": metrics.mean_tpot_ms,
       "median_tpot_ms": metrics.median_tpot_ms,
-      "p99_tpot_ms": metrics.p99_tpot_ms,
+      "mean_itl_ms": metrics.mean_itl_ms,
+      "median_itl_ms": metrics.median_itl_ms,
+      "mean_e2el_ms": metrics.mean_e2el_ms,
+      "median_e2el_ms": metrics.median_e2el_ms,
+      "mean_queue_delay_ms": metrics.mean_queue_delay_ms,
+      "median_queue_delay_ms": metrics.median_queue_delay_ms,
   }
+  for p, value in metrics.percentiles_ttft_ms:
+    result[f"p{p:g}_ttft_ms"] = value
+  for p, value in metrics.percentiles_tpot_ms:
+    result[f"p{p:g}_tpot_ms"] = value
+  for p, value in metrics.percentiles_itl_ms:
+    result[f"p{p:g}_itl_ms"] = value
+  for p, value in metrics.percentiles_e2el_ms:
+    result[f"p{p:g}_e2el_ms"] = value
+  for p, value in metrics.percentiles_queue_delay_ms:
+    result[f"p{p:g}_queue_delay_ms"] = value
   return result, outputs
 
 
-def mock_requests(total_mock_requests: int):
+def mock_requests(total_mock_requests: int) -> List[InputRequest]:
   """Generates a list of mock requests containing mock data."""
-  data = []
-  for _ in range(total_mock_requests):
-    reqeust = InputRequest()
-    reqeust.prompt = f"Prompt {random.randint(1, 1000)}"
-    reqeust.prompt_len = random.randint(10, 100)
-    reqeust.out = f"Output {random.randint(1, 1000)}"
-    reqeust.output_len = random.randint(1, 10)
-    data.append(reqeust)
-  return data
+  return [
+      InputRequest(
+          prompt=f"Prompt {random.randint(1, 1000)}",
+          prompt_len=random.randint(10, 100),
+          output=f"Output {random.randint(1, 1000)}",
+          output_len=random.randint(1, 10),
+      )
+      for _ in range(total_mock_requests)
+  ]
+
+
+def positive_int(value: str) -> int:
+  """Parses an integer flag value that must be at least 1."""
+  result = int(value)
+  if result < 1:
+    raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+  return result
+
+
+def percentile_list(value: str) -> List[float]:
+  """Parses a comma-separated list of percentiles between 0 and 100."""
+  percentiles = []
+  for item in value.split(","):
+    try:
+      p = float(item)
+    except ValueError:
+      raise argparse.ArgumentTypeError(
+          f"invalid percentile {item!r} in {value!r}"
+      ) from None
+    if not 0 <= p <= 100:
+      raise argparse.ArgumentTypeError(
+          f"percentile {item!r} is not between 0 and 100"
+      )
+    percentiles.append(p)
+  return percentiles
 
 
 def main(args: argparse.Namespace):
   print(args)
+  if args.threads is not None:
+    print(
+        "Warning: --threads is deprecated and has no effect; use"
+        " --max-concurrency to limit the number of in-flight requests."
+    )
   random.seed(args.seed)
   np.random.seed(args.seed)
 
@@ -388,7 +685,15 @@ def main(args: argparse.Namespace):
   if tokenizer == "test" or args.dataset == "test":
     input_requests = mock_requests(args.total_mock_requests) # e.g. [("AB", 2, "AB", 3)]
   else:
-    input_requests = sample_requests(args.dataset, args.num_prompts, tokenizer, args.max_output_length)
+    input_requests = sample_requests(
+        args.dataset,
+        args.num_prompts,
+        tokenizer,
+        tokenizer_id,
+        args.max_output_length,
+        args.tokenized_dataset_cache_dir,
+        args.seed,
+    )
 
   benchmark_result, request_outputs = asyncio.run(
       benchmark(
@@ -399,7 +704,9 @@ def main(args: argparse.Namespace):
           disable_tqdm=args.disable_tqdm,
           session_cache=args.session_cache,
           priority=args.priority,
-          threads=args.threads,
+          max_concurrency=args.max_concurrency,
+          num_channels=args.num_channels,
+          selected_percentiles=args.metric_percentiles,
       )
   )
 
@@ -427,13 +734,22 @@ def main(args: argparse.Namespace):
     file_name = (
         f"JetStream-{args.request_rate}qps-{base_model_id}-{current_dt}.json"
     )
-    with open(file_name, "w") as outfile:
-      json.dump(result_json, outfile)
+    with open(file_name, "wb") as outfile:
+      outfile.write(
+          orjson.dumps(result_json, option=orjson.OPT_SERIALIZE_NUMPY)
+      )
 
   if args.save_request_outputs:
     file_path = args.request_outputs_file_path
-    with open(file_path, "w") as output_file:
-        json.dump([output.to_dict() for output in request_outputs], output_file, indent=4) 
+    with open(file_path, "wb") as output_file:
+      # Write the outputs one at a time rather than building the whole list.
+      output_file.write(b"[")
+      for i, output in enumerate(request_outputs):
+        output_file.write(b",\n" if i else b"\n")
+        output_file.write(
+            orjson.dumps(output.to_dict(), option=orjson.OPT_INDENT_2)
+        )
+      output_file.write(b"\n]\n")
 
 
 if __name__ == "__main__":
@@ -489,11 +805,31 @@ if __name__ == "__main__":
           "the request arrival times."
       ),
   )
+  parser.add_argument(
+      "--max-concurrency",
+      type=positive_int,
+      default=None,
+      help=(
+          "The maximum number of requests in flight at the same time. By"
+          " default there is no limit. Time a request spends waiting for a"
+          " free slot is reported as its queue delay, separately from TTFT"
+          " and latency."
+      ),
+  )
   parser.add_argument(
       "--threads",
       type=int,
-      default=110,
-      help="The maximum number of threads used for request dispatching.",
+      default=None,
+      help=(
+          "Deprecated and ignored. Requests are no longer dispatched on a"
+          " thread pool; use --max-concurrency to limit in-flight requests."
+      ),
+  )
+  parser.add_argument(
+      "--num-channels",
+      type=positive_int,
+      default=1,
+      help="The number of gRPC channels to spread requests across.",
   )
   parser.add_argument(
       "--total-mock-requests",
@@ -502,6 +838,15 @@ if __name__ == "__main__":
       help="The maximum number of mock requests to send for benchmark testing.",
   )
 
+  parser.add_argument(
+      "--tokenized-dataset-cache-dir",
+      type=str,
+      default=os.path.join(os.path.expanduser("~"), ".cache", "jetstream"),
+      help=(
+          "Directory to cache the tokenized dataset in, so repeated runs skip"
+          " tokenization. Set to an empty string to disable the cache."
+      ),
+  )
   parser.add_argument(
       "--max-output-length",
       type=int,
@@ -538,6 +883,16 @@ if __name__ == "__main__":
           " not implemented, use default empty str)"
       ),
   )
+  parser.add_argument(
+      "--metric-percentiles",
+      type=percentile_list,
+      default="99",
+      help=(
+          "Comma-separated list of percentiles to report for TTFT, TPOT, ITL,"
+          ' E2EL and queue delay, e.g. "90,99". The median is always'
+          " reported, so including 50 repeats it as P50."
+      ),
+  )
   parser.add_argument(
       "--save-request-outputs",
       action="store_true",
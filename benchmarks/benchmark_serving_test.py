@@ -0,0 +1,108 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests the metric calculation of the serving benchmark."""
+
+import array
+import itertools
+
+import numpy as np
+from benchmarks import benchmark_serving
+from absl.testing import absltest
+
+
+def _make_output(token_times_ms: list[int]) -> benchmark_serving.RequestFuncOutput:
+  """Returns a successful output with tokens arriving at the given times."""
+  output = benchmark_serving.RequestFuncOutput()
+  output.input_request = benchmark_serving.InputRequest("prompt", 10, "", 8)
+  output.prompt_len = 10
+  output.generated_text = "t" * len(token_times_ms)
+  output.token_end_offsets = array.array(
+      "I", range(1, len(token_times_ms) + 1)
+  )
+  output.token_times_ns = array.array(
+      "q", (t * 1_000_000 for t in token_times_ms)
+  )
+  output.ttft = token_times_ms[0] / 1000 if token_times_ms else 0
+  output.latency = (token_times_ms[-1] if token_times_ms else 1) / 1000
+  output.success = True
+  return output
+
+
+class CalculateMetricsTest(absltest.TestCase):
+
+  def test_itl_with_empty_and_single_token_outputs_in_every_position(self):
+    token_times_ms = {
+        "empty": [],
+        "single": [5],
+        "multi": [1, 3, 7],
+    }
+    for order in itertools.permutations(token_times_ms):
+      with self.subTest(order=order):
+        metrics = benchmark_serving.calculate_metrics(
+            outputs=[_make_output(token_times_ms[name]) for name in order],
+            dur_s=1.0,
+            tokenizer="",
+            selected_percentiles=[0, 100],
+        )
+        self.assertEqual(metrics.completed, 3)
+        self.assertEqual(metrics.total_output, 4)
+        # Only the multi-token output contributes ITLs of 2 and 4 ms.
+        self.assertAlmostEqual(metrics.mean_itl_ms, 3.0)
+        self.assertEqual(
+            [p for p, _ in metrics.percentiles_itl_ms], [0, 100]
+        )
+        np.testing.assert_allclose(
+            [value for _, value in metrics.percentiles_itl_ms], [2.0, 4.0]
+        )
+
+  def test_tpot_skips_empty_outputs(self):
+    metrics = benchmark_serving.calculate_metrics(
+        outputs=[_make_output([]), _make_output([1, 3, 6]), _make_output([])],
+        dur_s=1.0,
+        tokenizer="",
+        selected_percentiles=[99],
+    )
+    # 6 ms latency over 3 tokens.
+    self.assertAlmostEqual(metrics.mean_tpot_ms, 2.0)
+    self.assertAlmostEqual(metrics.median_tpot_ms, 2.0)
+    self.assertAlmostEqual(metrics.percentiles_tpot_ms[0][1], 2.0)
+
+  def test_queue_delay_is_reported_separately(self):
+    outputs = [_make_output([1, 3]), _make_output([2, 4])]
+    outputs[0].queue_delay = 0.1
+    outputs[1].queue_delay = 0.3
+    metrics = benchmark_serving.calculate_metrics(
+        outputs=outputs,
+        dur_s=1.0,
+        tokenizer="",
+        selected_percentiles=[100],
+    )
+    self.assertAlmostEqual(metrics.mean_queue_delay_ms, 200.0)
+    self.assertAlmostEqual(metrics.percentiles_queue_delay_ms[0][1], 300.0)
+    self.assertAlmostEqual(metrics.mean_ttft_ms, 1.5)
+
+  def test_itl_without_multi_token_outputs(self):
+    metrics = benchmark_serving.calculate_metrics(
+        outputs=[_make_output([5]), _make_output([]), _make_output([2])],
+        dur_s=1.0,
+        tokenizer="",
+        selected_percentiles=[99],
+    )
+    self.assertEqual(metrics.mean_itl_ms, 0.0)
+    self.assertEqual(metrics.percentiles_itl_ms, [(99, 0.0)])
+
+
+if __name__ == "__main__":
+  absltest.main()